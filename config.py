@@ -1,4 +1,4 @@
-ip_version_priority = "ipv6"
+ip_version_priority = "auto"
 
 source_urls = [
  "http://140.210.9.53:6789/L00001live.txt",
@@ -1,12 +1,39 @@
 import re
+import socket
+import ipaddress
 import requests
 import logging
+import concurrent.futures
+import time
+from itertools import zip_longest
+from urllib.parse import urlparse
 from collections import OrderedDict
 from datetime import datetime
 import config
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[logging.FileHandler("function.log", "w", encoding="utf-8"), logging.StreamHandler()])
 
+# 用于探测本机IPv4/IPv6连通性的公共DNS服务器（TCP 53端口）
+IP_STACK_PROBE_TARGETS = {
+    "ipv4": [("223.5.5.5", 53), ("119.29.29.29", 53), ("8.8.8.8", 53)],
+    "ipv6": [("2400:3200::1", 53), ("2402:4e00::", 53), ("2001:4860:4860::8888", 53)],
+}
+DEFAULT_PORTS = {"http": 80, "https": 443, "rtsp": 554, "rtmp": 1935}
+PROBE_TIMEOUT = 2
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# udpxy等组播转单播代理的路径特征，如 http://host:4022/rtp/225.1.4.73:1102
+RELAY_PATH_PATTERN = re.compile(r'^/(rtp|udp)/', re.IGNORECASE)
+RELAY_SAMPLE_SIZE = 2
+RELAY_READ_BYTES = 256 * 1024
+RELAY_READ_TIMEOUT = 3
+
+ip_stack = {"ipv4": True, "ipv6": True}
+dns_cache = {}
+host_states = {}
+relay_hosts = {}
+relay_channels = {}
+
 def parse_template(template_file):
     """解析模板文件，获取频道结构"""
     template_channels = OrderedDict()
@@ -114,16 +141,30 @@ def match_channels(template_channels, all_channels):
                             matched_channels[category][channel_name] = []
                         matched_channels[category][channel_name].append(online_channel_url)
 
+    all_urls = [
+        url
+        for channel_urls in matched_channels.values()
+        for urls in channel_urls.values()
+        for url in urls
+    ]
+
+    # 批量解析主机名并判断IP版本，再按本机实际可达的协议栈排序
+    classify_hosts(all_urls)
+
+    # 组播代理按主机分组探测，每个主机只测一次
+    probe_relay_hosts(all_urls)
+
     # 对每个频道的URL进行筛选，保留最好的4个源
     for category in matched_channels:
         for channel_name in matched_channels[category]:
-            urls = matched_channels[category][channel_name]
+            urls = sort_by_ip_version(sort_relay_urls(matched_channels[category][channel_name]))
             matched_channels[category][channel_name] = filter_henan_sources(urls)
 
     return matched_channels
 
 def filter_source_urls(template_file):
     """过滤源URL，获取匹配的频道"""
+    detect_ip_stack()
     template_channels = parse_template(template_file)
     source_urls = config.source_urls
 
@@ -140,9 +181,295 @@ def filter_source_urls(template_file):
 
     return matched_channels, template_channels
 
+def try_connect(address, port, timeout=PROBE_TIMEOUT):
+    """尝试建立TCP连接，成功返回True"""
+    try:
+        with socket.create_connection((address, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def detect_ip_stack():
+    """启动时检测本机IPv4/IPv6的实际连通性"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+        future_to_version = {
+            executor.submit(try_connect, address, port): version
+            for version, targets in IP_STACK_PROBE_TARGETS.items()
+            for address, port in targets
+        }
+        reachable = {version: False for version in IP_STACK_PROBE_TARGETS}
+        for future in concurrent.futures.as_completed(future_to_version):
+            if future.result():
+                reachable[future_to_version[future]] = True
+
+    # 两种协议都探测失败时多半是探测目标被屏蔽，保持默认的双栈可用
+    if any(reachable.values()):
+        ip_stack.update(reachable)
+    logging.info(f"本机网络: IPv4{'可用' if ip_stack['ipv4'] else '不可用'}，IPv6{'可用' if ip_stack['ipv6'] else '不可用'}，优先使用{get_ip_version_priority().upper()}")
+    return ip_stack
+
+def get_ip_version_priority():
+    """根据配置和本机连通性决定优先使用的IP版本"""
+    priority = getattr(config, 'ip_version_priority', 'auto')
+    if ip_stack["ipv4"] and ip_stack["ipv6"]:
+        return priority if priority in ("ipv4", "ipv6") else "ipv6"
+    if ip_stack["ipv6"]:
+        return "ipv6"
+    return "ipv4"
+
+def get_host_port(url):
+    """从URL中解析主机和端口"""
+    try:
+        parsed = urlparse(url.split('$', 1)[0])
+        host = parsed.hostname
+        port = parsed.port or DEFAULT_PORTS.get(parsed.scheme)
+    except ValueError:
+        return None, None
+    return host, port
+
+def resolve_host(host):
+    """解析主机名，返回(IPv4地址列表, IPv6地址列表)，结果缓存"""
+    if host in dns_cache:
+        return dns_cache[host]
+
+    ipv4_addrs, ipv6_addrs = [], []
+    try:
+        for family, _, _, _, sockaddr in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP):
+            if family == socket.AF_INET and sockaddr[0] not in ipv4_addrs:
+                ipv4_addrs.append(sockaddr[0])
+            elif family == socket.AF_INET6 and sockaddr[0] not in ipv6_addrs:
+                ipv6_addrs.append(sockaddr[0])
+    except (socket.gaierror, UnicodeError):
+        pass
+
+    dns_cache[host] = (ipv4_addrs, ipv6_addrs)
+    return dns_cache[host]
+
+def happy_eyeballs_probe(port, ipv4_addrs, ipv6_addrs):
+    """按Happy Eyeballs方式探测双栈主机，返回先连通的IP版本"""
+    addrs = {"ipv4": ipv4_addrs, "ipv6": ipv6_addrs}
+    first = get_ip_version_priority()
+    second = "ipv4" if first == "ipv6" else "ipv6"
+    # 两种协议的地址交替尝试，优先协议在前
+    attempts = [
+        (version, address)
+        for pair in zip_longest(addrs[first], addrs[second])
+        for version, address in zip((first, second), pair)
+        if address
+    ]
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(attempts))
+    try:
+        future_to_version = {}
+        for version, address in attempts:
+            future_to_version[executor.submit(try_connect, address, port)] = version
+            # 等待短暂延迟，期间有尝试失败则立即发起下一个地址
+            done, _ = concurrent.futures.wait(future_to_version, timeout=HAPPY_EYEBALLS_DELAY, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                done_version = future_to_version.pop(future)
+                if future.result():
+                    return done_version
+        for future in concurrent.futures.as_completed(future_to_version):
+            if future.result():
+                return future_to_version[future]
+    finally:
+        # 不等待落后的连接尝试，否则耗时取决于较慢的一方
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return None
+
+def classify_host(host, port):
+    """判断主机的IP版本及本机能否连通，返回(IP版本, 是否可达)，解析失败时IP版本为None"""
+    try:
+        version = "ipv6" if ipaddress.ip_address(host).version == 6 else "ipv4"
+        return version, ip_stack[version]
+    except ValueError:
+        pass
+
+    ipv4_addrs, ipv6_addrs = resolve_host(host)
+    ipv4_usable = bool(ipv4_addrs) and ip_stack["ipv4"]
+    ipv6_usable = bool(ipv6_addrs) and ip_stack["ipv6"]
+    if ipv4_usable and ipv6_usable:
+        priority = get_ip_version_priority()
+        # 未知协议没有默认端口，无法探测，按优先协议处理
+        if port is None:
+            return priority, True
+        version = happy_eyeballs_probe(port, ipv4_addrs, ipv6_addrs)
+        return (version, True) if version else (priority, False)
+    if ipv6_usable:
+        return "ipv6", True
+    if ipv4_usable:
+        return "ipv4", True
+    # 本机不可达的协议仍记录IP版本，用于标注线路
+    if ipv6_addrs:
+        return "ipv6", False
+    if ipv4_addrs:
+        return "ipv4", False
+    return None, False
+
+def classify_hosts(urls):
+    """批量解析并判断所有URL主机的IP版本"""
+    host_ports = set()
+    for url in urls:
+        host_port = get_host_port(url)
+        if host_port[0] and host_port not in host_states:
+            host_ports.add(host_port)
+
+    if not host_ports:
+        return
+
+    hosts = {host for host, _ in host_ports}
+    logging.info(f"开始解析 {len(hosts)} 个主机名，判断 {len(host_ports)} 个主机端口的IP版本...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        # 先对去重后的主机名批量解析填充DNS缓存，再按端口探测
+        list(executor.map(resolve_host, hosts))
+        future_to_host_port = {executor.submit(classify_host, host, port): (host, port) for host, port in host_ports}
+        for future in concurrent.futures.as_completed(future_to_host_port):
+            host_port = future_to_host_port[future]
+            host_states[host_port] = future.result()
+
+def get_host_state(url):
+    """获取URL主机的(IP版本, 是否可达)"""
+    host_port = get_host_port(url)
+    if not host_port[0]:
+        return None, False
+    if host_port not in host_states:
+        host_states[host_port] = classify_host(*host_port)
+    return host_states[host_port]
+
+def get_ip_version(url):
+    """获取URL对应的IP版本，未知时返回None"""
+    return get_host_state(url)[0]
+
+def ip_version_rank(url, priority):
+    """排序权重：可达的优先协议、可达的其他协议、本机不可达、无法解析"""
+    version, reachable = get_host_state(url)
+    if version is None:
+        return 3
+    if not reachable:
+        return 2
+    return 0 if version == priority else 1
+
+def sort_by_ip_version(urls):
+    """按本机可达性和优先IP版本排序，本机不可达或代理探测失败的URL排在最后而不删除"""
+    priority = get_ip_version_priority()
+    return sorted(urls, key=lambda url: max(ip_version_rank(url, priority), relay_rank(url)))
+
+def is_relay_url(url):
+    """检查是否为udpxy等组播代理地址"""
+    try:
+        parsed = urlparse(url.split('$', 1)[0])
+    except ValueError:
+        return False
+    return parsed.scheme == "http" and RELAY_PATH_PATTERN.match(parsed.path) is not None
+
+def read_stream(url, max_bytes=RELAY_READ_BYTES, timeout=RELAY_READ_TIMEOUT):
+    """短时读取直播流，返回吞吐量(字节/秒)，读不到数据返回None"""
+    received = 0
+    start_time = time.time()
+    try:
+        with requests.get(url.split('$', 1)[0], stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                received += len(chunk)
+                if received >= max_bytes or time.time() - start_time >= timeout:
+                    break
+    except requests.RequestException:
+        # 已收到部分数据后超时的频道仍可播放，只是较慢
+        pass
+    elapsed = time.time() - start_time
+    return received / max(elapsed, 0.001) if received else None
+
+def check_relay_status(host, port):
+    """访问代理的状态页，确认代理服务在线"""
+    # urlparse得到的IPv6主机不带方括号，拼接URL时需补上
+    netloc = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+    try:
+        response = requests.get(f"http://{netloc}/status", timeout=PROBE_TIMEOUT)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def probe_relay_host(host, port, channel_urls):
+    """探测单个代理主机，返回(主机是否在线, 未抽样频道沿用的吞吐量, 抽样频道的吞吐量)"""
+    status_ok = check_relay_status(host, port)
+    sample_results = {url: read_stream(url) for url in channel_urls[:RELAY_SAMPLE_SIZE]}
+
+    # 状态页在线或任一抽样频道可读即视为主机在线；未抽样频道按最慢的成功抽样估计
+    throughputs = [speed for speed in sample_results.values() if speed]
+    return status_ok or bool(throughputs), (min(throughputs) if throughputs else None), sample_results
+
+def probe_relay_hosts(urls):
+    """按主机分组探测组播代理，探测次数随主机数而非频道数增长"""
+    hosts = OrderedDict()
+    for url in urls:
+        if not url or not is_relay_url(url):
+            continue
+        if any(blacklist in url for blacklist in config.url_blacklist):
+            continue
+        host_port = get_host_port(url)
+        if host_port[0] and host_port not in relay_hosts and host_states.get(host_port, (None, False))[1]:
+            hosts.setdefault(host_port, [])
+            if url not in hosts[host_port]:
+                hosts[host_port].append(url)
+
+    if not hosts:
+        return
+
+    channel_count = sum(len(channel_urls) for channel_urls in hosts.values())
+    logging.info(f"开始探测 {len(hosts)} 个组播代理主机（共 {channel_count} 个频道地址）...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        future_to_host_port = {
+            executor.submit(probe_relay_host, host, port, channel_urls): (host, port)
+            for (host, port), channel_urls in hosts.items()
+        }
+        for future in concurrent.futures.as_completed(future_to_host_port):
+            host_port = future_to_host_port[future]
+            alive, throughput, sample_results = future.result()
+            relay_hosts[host_port] = (alive, throughput)
+            relay_channels.update(sample_results)
+            if not alive:
+                logging.info(f"组播代理 {host_port[0]}:{host_port[1]} 探测失败❌，{len(hosts[host_port])} 个频道地址排在最后")
+
+    alive_count = sum(1 for host_port in hosts if relay_hosts[host_port][0])
+    logging.info(f"组播代理探测完成，可用主机 {alive_count}/{len(hosts)}")
+
+def get_relay_throughput(url):
+    """获取代理地址的吞吐量，未抽样的频道沿用主机最慢的成功抽样，无法排序时返回None"""
+    if url in relay_channels:
+        return relay_channels[url]
+    return relay_hosts[get_host_port(url)][1]
+
+def is_relay_alive(url):
+    """代理主机在线且该频道未在抽样中失败"""
+    if not relay_hosts[get_host_port(url)][0]:
+        return False
+    return url not in relay_channels or relay_channels[url] is not None
+
+def is_probed_relay(url):
+    """检查URL是否为已探测过的代理地址"""
+    return bool(url) and is_relay_url(url) and get_host_port(url) in relay_hosts
+
+def relay_rank(url):
+    """探测失败的代理地址与本机不可达的URL同等排序权重"""
+    return 2 if is_probed_relay(url) and not is_relay_alive(url) else 0
+
+def sort_relay_urls(urls):
+    """代理地址之间按可用性和吞吐量排序，其他URL位置不变"""
+    sorted_urls = list(urls)
+    relay_indexes = [index for index, url in enumerate(sorted_urls) if is_probed_relay(url)]
+    sorted_relays = sorted(
+        (sorted_urls[index] for index in relay_indexes),
+        key=lambda url: (is_relay_alive(url), get_relay_throughput(url) or 0),
+        reverse=True,
+    )
+    for index, url in zip(relay_indexes, sorted_relays):
+        sorted_urls[index] = url
+    return sorted_urls
+
 def is_ipv6(url):
     """检查是否为IPv6地址"""
-    return re.match(r'^http:\/\/\[[0-9a-fA-F:]+\]', url) is not None
+    return get_ip_version(url) == "ipv6"
 
 def updateChannelUrlsM3U(channels, template_channels):
     """更新频道URL并生成M3U和TXT文件"""